@@ -3,114 +3,260 @@ import streamlit as st
 import numpy as np
 import pandas as pd
 import joblib
+import os
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from onnx_model import OnnxModel, ort
+
+# Must be the first Streamlit call: the page chrome renders before the (cached) model load,
+# so a missing model file shows its error inside a correctly configured page
+st.set_page_config(page_title="AHD Detection", layout="wide", page_icon="🧠")
+
+# The LZ4/protocol-5 re-dump from export_model.py loads faster; the original pickle is the fallback
+MODEL_PATHS = ("ahd_model_C_hybrid_fixed.lz4.joblib", "ahd_model_C_hybrid_fixed.pkl")
+BATCH_CHUNK_ROWS = 65_536  # bounds peak memory when scoring large uploads
+# Single input dtype for every path: the forest's trees and the ONNX export's FloatTensorType both
+# consume float32, so raw widget values are cast exactly once, when written into X
+INPUT_DTYPE = np.float32
+
+# Static page text, kept together here so the page layout below reads more easily
+HEADER_MD = """
+This tool helps clinicians assess the risk of **Advanced HIV Disease (AHD)**  
+based on patient details such as age, weight, CD4 count, viral load, and treatment history.  
+"""
+FOOTER_HTML = "<div style='text-align:center; color:gray;'>© 2025 | Built with ❤️ by <b>Idah Anyango</b></div>"
+
+# Produced offline by export_model.py
+ONNX_PATH = "ahd_model_C_hybrid_fixed.onnx"
+
+# Selectbox value -> one-hot column it switches on. 'Unknown' risk and WHO stage 1
+# are the dropped reference levels, so they have no column of their own.
+CD4_RISK_SLOT = {'Severe': 'cd4_risk_Severe', 'Moderate': 'cd4_risk_Moderate', 'Normal': 'cd4_risk_Normal', 'Unknown': None}
+WHO_SLOT = {1: None, 2: 'Last_WHO_Stage_2', 3: 'Last_WHO_Stage_3', 4: 'Last_WHO_Stage_4'}
+SEX_M = {'Male': 1.0, 'Female': 0.0}
+
+
+@st.cache_resource
+def load_model(paths=MODEL_PATHS, onnx_path=ONNX_PATH):
+    """Load the deployable object once per process and share it across sessions.
+
+    Prefers an exported ONNX model when one exists and onnxruntime is installed, falling
+    back to the joblib pickle if the export cannot be loaded. Returns
+    (model, feature_names, model_key, backend, onnx_error); model_key is the loaded artifact's
+    (path, mtime), used to say which artifact is scoring and to key cached batch scores.
+    """
+    onnx_error = None
+    if ort is not None and os.path.exists(onnx_path):
+        try:
+            model = OnnxModel(onnx_path)
+            return model, model.feature_names, (onnx_path, os.path.getmtime(onnx_path)), "onnxruntime", None
+        except Exception as e:  # corrupt/incompatible graph, or an export without feature_names metadata
+            onnx_error = f"{type(e).__name__}: {e}"
+
+    # Falls through to the last path so a missing file still raises FileNotFoundError
+    path = next((p for p in paths if os.path.exists(p)), paths[-1])
+    deploy = joblib.load(path)
+    return deploy['model'], list(deploy['feature_names']), (path, os.path.getmtime(path)), "scikit-learn", onnx_error
+
+
+@st.cache_resource
+def make_filler(feature_names):
+    """Build a fill(X, ...) function that closes over precomputed column positions.
+
+    The schema is fixed once the model is loaded, so the name -> index lookups are
+    resolved here instead of on every call.
+    """
+    pos = {name: i for i, name in enumerate(feature_names)}
+    age_i, weight_i, height_i, cd4_i, vl_i, months_rx_i = (pos[name] for name in (
+        'Age at reporting', 'Weight', 'Height', 'Latest CD4 Result', 'Last VL Result', 'Months of Prescription'))
+    bmi_i, cd4_missing_i, vl_missing_i, vl_suppressed_i, sex_m_i = (pos[name] for name in (
+        'BMI', 'CD4_Missing', 'VL_Missing', 'VL_Suppressed', 'Sex_M'))
+    cd4_risk_pos = {k: (pos[col] if col else None) for k, col in CD4_RISK_SLOT.items()}
+    who_pos = {k: (pos[col] if col else None) for k, col in WHO_SLOT.items()}
+
+    # Every flag, unselected one-hot and the PMTCT/Cacx/Refill missingness flags (always 0
+    # at inference, same names the training script used) stay at the zero X starts from.
+    def fill(X, age, weight, height, cd4, vl, months_rx, who_stage, cd4_risk, sex):
+        X[0, age_i] = age
+        X[0, weight_i] = weight
+        X[0, height_i] = height
+        X[0, cd4_i] = cd4
+        X[0, vl_i] = vl
+        X[0, months_rx_i] = months_rx
+
+        # Derived fields (exact same transformations as training)
+        if height and height > 0:
+            X[0, bmi_i] = weight / ((height / 100) ** 2)
+        if cd4 <= 0:
+            X[0, cd4_missing_i] = 1
+        if vl <= 0:
+            X[0, vl_missing_i] = 1
+        if vl < 1000:
+            X[0, vl_suppressed_i] = 1
+        X[0, sex_m_i] = SEX_M[sex]
+
+        # One-hot categories: only the selected level has a column to switch on
+        for col in (cd4_risk_pos[cd4_risk], who_pos[who_stage]):
+            if col is not None:
+                X[0, col] = 1
+
+    return fill
+
+
+@st.cache_data(max_entries=128)
+def build_feature_vector(feature_names, age, weight, height, cd4, vl, months_rx, who_stage, cd4_risk, sex):
+    """Turn the raw sidebar inputs into the model's (1, n) feature row.
+
+    Cached on the schema (a tuple of feature names) and the raw inputs, so reruns triggered
+    by unrelated widgets reuse the last row and a different model never gets a stale one.
+    """
+    # INPUT_DTYPE/F-order matches what the model consumes, so it skips the upcast+copy
+    X = np.zeros((1, len(feature_names)), dtype=INPUT_DTYPE, order='F')
+    make_filler(feature_names)(X, age, weight, height, cd4, vl, months_rx, who_stage, cd4_risk, sex)
+    return X
+
+
+def to_model_input(model, feature_names, X):
+    """Wrap X for the model without copying; the sklearn model was fitted on a DataFrame."""
+    if hasattr(model, "feature_names_in_"):
+        return pd.DataFrame(X, columns=list(feature_names), copy=False)
+    return X
+
+
+@st.cache_data(max_entries=4)
+def score_batch(model_key, backend, feature_names, file_id, filename, _model, _upload):
+    """Score every row of an uploaded CSV/Parquet file with vectorised predict_proba calls.
+
+    Keyed on the loaded model (model_key), its schema and the upload's file_id; the model
+    and the UploadedFile are left out of the cache key, and the bytes are only read on a miss.
+    """
+    buf = pa.BufferReader(_upload.getvalue())
+    table = pq.read_table(buf) if filename.lower().endswith(".parquet") else pa_csv.read_csv(buf)
+    if len(set(table.column_names)) != table.num_columns:
+        duplicated = sorted({name for name in table.column_names if table.column_names.count(name) > 1})
+        raise ValueError(f"Duplicated column names: {', '.join(duplicated)}")
+    missing = [name for name in feature_names if name not in table.column_names]
+    if missing:
+        raise ValueError(f"Missing feature columns: {', '.join(missing)}")
+    if table.num_rows == 0:
+        raise ValueError("The file has no patient rows.")
+    # Blank cells would reach the model as NaN, which the sklearn forest and the ONNX export route
+    # differently; missingness must be encoded explicitly (CD4_Missing/VL_Missing) as in the sidebar
+    with_nulls = [name for name in feature_names if table.column(name).null_count > 0]
+    if with_nulls:
+        raise ValueError(f"Blank values in feature columns: {', '.join(with_nulls)}")
+
+    # Copy each Arrow column straight into X, allocated in the layout the backend consumes:
+    # row-major for onnxruntime, column-major for the sklearn forest. Either way no
+    # intermediate pandas block or later layout copy is needed.
+    order = 'C' if backend == "onnxruntime" else 'F'
+    X = np.empty((table.num_rows, len(feature_names)), dtype=INPUT_DTYPE, order=order)
+    for j, name in enumerate(feature_names):
+        X[:, j] = table.column(name).to_numpy()
+    proba = np.concatenate([
+        _model.predict_proba(to_model_input(_model, feature_names, X[i:i + BATCH_CHUNK_ROWS]))[:, 1]
+        for i in range(0, len(X), BATCH_CHUNK_ROWS)
+    ])
+
+    # Carry any non-feature columns (patient ID, facility, ...) through so scores can be matched back
+    feature_set = set(feature_names)
+    results = table.select([name for name in table.column_names if name not in feature_set]).to_pandas()
+    results["AHD Risk"] = np.where(proba > 0.5, "Yes", "No")
+    results["Risk Probability"] = proba
+    return results
+
+
+st.title("🧠 Advanced HIV Disease (AHD) Detection")
+st.markdown(HEADER_MD)
 
 # Load deployable object (contains 'model' and ordered 'feature_names')
 try:
-    deploy = joblib.load("ahd_model_C_hybrid_fixed.pkl")
-    model = deploy['model']
-    feature_names = deploy['feature_names']
+    model, feature_names, model_key, backend, onnx_error = load_model()
+    schema = tuple(feature_names)
     model_loaded = True
 except FileNotFoundError:
     st.error("Model file 'ahd_model_C_hybrid_fixed.pkl' not found. Please ensure it's uploaded.")
     model_loaded = False
 
-st.set_page_config(page_title="AHD Detection", layout="wide", page_icon="🧠")
-st.title("🧠 Advanced HIV Disease (AHD) Detection")
-st.markdown("""
-This tool helps clinicians assess the risk of **Advanced HIV Disease (AHD)**  
-based on patient details such as age, weight, CD4 count, viral load, and treatment history.  
-""")
+if model_loaded:
+    if onnx_error:
+        st.warning(f"Could not load '{ONNX_PATH}' ({onnx_error}); falling back to the joblib model.")
+    st.caption(f"Scoring with {backend} · `{model_key[0]}`")
 
 st.sidebar.header("📝 Patient Information")
 
 if model_loaded:
     # Input fields (same as training features)
-    age = st.sidebar.number_input("Age at Reporting", min_value=0, max_value=120, value=35)
-    weight = st.sidebar.number_input("Weight (kg)", min_value=20.0, max_value=200.0, value=60.0)
-    height = st.sidebar.number_input("Height (cm)", min_value=100, max_value=220, value=165)
-    cd4 = st.sidebar.number_input("Latest CD4 Count", min_value=0, max_value=2000, value=350)
-    vl = st.sidebar.number_input("Latest Viral Load (copies/ml)", min_value=0, max_value=10000000, value=1000)
-    months_rx = st.sidebar.slider("Months of Prescription", 0, 6, 3)
-    who_stage = st.sidebar.selectbox("Last WHO Stage", [1, 2, 3, 4])
-    cd4_risk = st.sidebar.selectbox("CD4 Risk Category", ["Severe", "Moderate", "Normal", "Unknown"]) # Added Unknown
-    sex = st.sidebar.selectbox("Sex", ["Female", "Male"])
+    age = st.sidebar.number_input("Age at Reporting", min_value=0, max_value=120, value=35, key="age")
+    weight = st.sidebar.number_input("Weight (kg)", min_value=20.0, max_value=200.0, value=60.0, key="weight")
+    height = st.sidebar.number_input("Height (cm)", min_value=100, max_value=220, value=165, key="height")
+    cd4 = st.sidebar.number_input("Latest CD4 Count", min_value=0, max_value=2000, value=350, key="cd4")
+    vl = st.sidebar.number_input("Latest Viral Load (copies/ml)", min_value=0, max_value=10000000, value=1000, key="vl")
+    months_rx = st.sidebar.slider("Months of Prescription", 0, 6, 3, key="months_rx")
+    who_stage = st.sidebar.selectbox("Last WHO Stage", [1, 2, 3, 4], key="who_stage")
+    cd4_risk = st.sidebar.selectbox("CD4 Risk Category", ["Severe", "Moderate", "Normal", "Unknown"], key="cd4_risk") # Added Unknown
+    sex = st.sidebar.selectbox("Sex", ["Female", "Male"], key="sex")
     st.sidebar.markdown("---")
 
-    # Derived fields (exact same transformations as training)
-    bmi = weight / ((height / 100) ** 2) if (height and height > 0) else 0
-    cd4_missing = 0 if cd4 > 0 else 1
-    vl_missing = 0 if vl > 0 else 1
-    vl_suppressed = 1 if vl < 1000 else 0
-
-    # Handle CD4 Risk Category one-hot encoding, including 'Unknown'
-    cd4_risk_Severe = 1 if cd4_risk == "Severe" else 0
-    cd4_risk_Moderate = 1 if cd4_risk == "Moderate" else 0
-    cd4_risk_Normal = 1 if cd4_risk == "Normal" else 0
-    # Assuming 'Unknown' is handled by the missing flag or not explicitly one-hot encoded if only Severe/Moderate/Normal are in features
-
-    Last_WHO_Stage_2 = 1 if who_stage == 2 else 0
-    Last_WHO_Stage_3 = 1 if who_stage == 3 else 0
-    Last_WHO_Stage_4 = 1 if who_stage == 4 else 0
-    Sex_M = 1 if sex.lower().startswith("m") else 0
-
-    # Default missingness flags (same names that training script used)
-    Active_in_PMTCT_Missing = 0
-    Cacx_Screening_Missing = 0
-    Refill_Date_Missing = 0
-
-    # Build feature-vector as a dictionary to map directly to feature names
-    input_data_dict = {
-        'Age at reporting': age,
-        'Weight': weight,
-        'Height': height,
-        'BMI': bmi,
-        'Latest CD4 Result': cd4,
-        'CD4_Missing': cd4_missing,
-        'Last VL Result': vl,
-        'VL_Suppressed': vl_suppressed,
-        'VL_Missing': vl_missing,
-        'Months of Prescription': months_rx,
-        'cd4_risk_Moderate': cd4_risk_Moderate,
-        'cd4_risk_Normal': cd4_risk_Normal,
-        'cd4_risk_Severe': cd4_risk_Severe,
-        'Last_WHO_Stage_2': Last_WHO_Stage_2,
-        'Last_WHO_Stage_3': Last_WHO_Stage_3,
-        'Last_WHO_Stage_4': Last_WHO_Stage_4,
-        'Active_in_PMTCT_Missing': Active_in_PMTCT_Missing,
-        'Cacx_Screening_Missing': Cacx_Screening_Missing,
-        'Refill_Date_Missing': Refill_Date_Missing,
-        'Sex_M': Sex_M
-    }
-
-    # Create DataFrame, ensuring correct order and types
-    # Use the feature_names from the loaded model object to ensure correct column order
-    X_input = pd.DataFrame([input_data_dict])[feature_names].astype(float)
-
-
-    # Prediction
-    if st.sidebar.button("🔍 Predict AHD Risk"):
-        pred = model.predict(X_input)[0]
-        proba = model.predict_proba(X_input)[0][1]  # prob of class 1 (AHD)
+    X = build_feature_vector(schema, age, weight, height, cd4, vl, months_rx, who_stage, cd4_risk, sex)
+    X_input = to_model_input(model, feature_names, X)
+
+    threshold = st.sidebar.slider("High-risk alert threshold", 0.45, 0.95, 0.75, step=0.05, key="threshold")
+    inputs = (age, weight, height, cd4, vl, months_rx, who_stage, cd4_risk, sex)
+
+    # Prediction: the model only runs on click; the result is kept in session state so
+    # moving the threshold slider re-renders the verdict without calling the model again
+    if st.sidebar.button("🔍 Predict AHD Risk", key="predict"):
+        # classes_ is [0, 1], so column 1 is the probability of AHD
+        st.session_state['last_proba'] = float(model.predict_proba(X_input)[0, 1])
+        st.session_state['last_inputs'] = inputs
+
+    if 'last_proba' in st.session_state and st.session_state['last_inputs'] != inputs:
+        st.info("Patient details changed – click **Predict AHD Risk** to update the result.")
+    elif 'last_proba' in st.session_state:
+        proba = st.session_state['last_proba']
+        pred = int(proba > 0.5)  # same as model.predict (argmax) without a second ensemble pass
 
         # Display results
         st.subheader("📌 Prediction Result")
-        st.metric("AHD Risk", "Yes" if int(pred) == 1 else "No")
+        st.metric("AHD Risk", "Yes" if pred == 1 else "No")
         st.metric("Risk Probability", f"{proba:.2%}")
 
         # Risk interpretation
         st.progress(proba)
-        if proba > 0.75:
+        if proba > threshold:
             st.error("⚠️ High Risk – Consider immediate clinical review.")
         elif proba > 0.45:
             st.warning("🟠 Moderate Risk – Monitor closely.")
         else:
             st.success("🟢 Low Risk – Continue routine care.")
 
-        # (optional) show the feature row so clinicians see what was fed
-        with st.expander("Input features (used for prediction)"):
-            st.write(X_input.T)
+        # (optional) show the feature row so clinicians see what was fed; built only on request
+        if st.checkbox("Show input features (used for prediction)", key="show_features"):
+            # X is float32; round so the display shows 22.0386 rather than 22.03856658935547
+            st.json({name: round(float(v), 4) for name, v in zip(feature_names, X[0])})
+
+    # Batch prediction: one vectorised call over many patients instead of one click each
+    st.subheader("📂 Batch Prediction")
+    uploaded = st.file_uploader(
+        "Upload a CSV or Parquet file with one patient per row (columns named as the model's features; "
+        "any other columns, e.g. a patient ID, are kept in the results)",
+        type=["csv", "parquet"],
+        key="batch_upload",
+    )
+    if uploaded is not None:
+        try:
+            results = score_batch(model_key, backend, schema, uploaded.file_id, uploaded.name, model, uploaded)
+        except ValueError as e:
+            st.error(f"Could not score '{uploaded.name}': {e}")
+        else:
+            st.dataframe(results, column_config={
+                "Risk Probability": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0, format="%.2f"),
+            })
 
 # Footer
 st.markdown("---")
-st.markdown("<div style='text-align:center; color:gray;'>© 2025 | Built with ❤️ by <b>Idah Anyango</b></div>", unsafe_allow_html=True)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)
 
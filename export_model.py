@@ -0,0 +1,91 @@
+"""Re-export the deployable joblib object in the faster-loading formats app.py looks for.
+
+Writes an LZ4-compressed pickle (protocol 5) and an ONNX model for onnxruntime. The ONNX
+file is only moved to the path app.py serves from once it matches the sklearn model on
+the holdout. Run once offline (requires skl2onnx and lz4):
+
+    python export_model.py --holdout holdout.csv
+"""
+import argparse
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+
+SRC_PATH = "ahd_model_C_hybrid_fixed.pkl"
+LZ4_PATH = "ahd_model_C_hybrid_fixed.lz4.joblib"
+ONNX_PATH = "ahd_model_C_hybrid_fixed.onnx"
+
+
+def dump_lz4(model, feature_names, path):
+    # Protocol 5 pickles NumPy buffers out-of-band, and LZ4 decompresses far faster than zlib
+    joblib.dump({'model': model, 'feature_names': feature_names}, path, compress=('lz4', 3), protocol=5)
+    print(f"Saved {path}")
+
+
+def export_onnx(model, feature_names, path):
+    # zipmap=False keeps probabilities as a plain (n, 2) tensor instead of a list of dicts
+    onx = convert_sklearn(
+        model,
+        initial_types=[('X', FloatTensorType([None, len(feature_names)]))],
+        options={id(model): {'zipmap': False}},
+        target_opset={'': 17, 'ai.onnx.ml': 3},
+    )
+
+    # Ship the column order inside the model so the app does not need the pickle at all
+    meta = onx.metadata_props.add()
+    meta.key = 'feature_names'
+    meta.value = json.dumps(feature_names)
+
+    with open(path, "wb") as f:
+        f.write(onx.SerializeToString())
+    print(f"Saved {path} ({len(feature_names)} features)")
+
+
+def check_holdout(model, feature_names, onnx_path, holdout_path, tol):
+    """Compare the ONNX probabilities against the sklearn model on a holdout CSV."""
+    import onnxruntime as ort
+
+    X = pd.read_csv(holdout_path)[feature_names].astype(np.float32)
+    expected = model.predict_proba(X)[:, 1]
+
+    sess = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    proba_name = sess.get_outputs()[1].name
+    # A float32 frame's to_numpy() comes back F-ordered; onnxruntime wants row-major input
+    got = sess.run([proba_name], {sess.get_inputs()[0].name: np.ascontiguousarray(X.to_numpy())})[0][:, 1]
+
+    max_diff = float(np.max(np.abs(got - expected)))
+    flips = int(np.sum((got > 0.5) != (expected > 0.5)))
+    print(f"{onnx_path}: max |Δproba| = {max_diff:.5f}, label flips = {flips}/{len(X)}")
+    return max_diff <= tol
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--holdout", required=True, help="CSV with the training feature columns, used to validate the exports")
+    parser.add_argument("--tol", type=float, default=0.01, help="max allowed probability difference on the holdout")
+    args = parser.parse_args()
+
+    deploy = joblib.load(SRC_PATH)
+    model = deploy['model']
+    feature_names = list(deploy['feature_names'])
+
+    dump_lz4(model, feature_names, LZ4_PATH)
+
+    # Export under a temporary name: app.py picks up any file at ONNX_PATH on its next start
+    tmp = ONNX_PATH + ".tmp"
+    export_onnx(model, feature_names, tmp)
+    if not check_holdout(model, feature_names, tmp, args.holdout, args.tol):
+        os.remove(tmp)
+        raise SystemExit(f"Export differs from the sklearn model by more than {args.tol}; nothing was shipped.")
+
+    os.replace(tmp, ONNX_PATH)
+    print(f"Shipped {ONNX_PATH}")
+
+
+if __name__ == "__main__":
+    main()
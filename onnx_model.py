@@ -0,0 +1,29 @@
+"""onnxruntime-backed model for app.py.
+
+Kept in its own module so the class has a stable identity: Streamlit re-executes app.py
+as a fresh __main__ on every rerun, while st.cache_resource keeps the instance from the first.
+"""
+import json
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+class OnnxModel:
+    """Thin predict_proba wrapper around an onnxruntime session."""
+
+    def __init__(self, path):
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, opts, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.proba_name = self.session.get_outputs()[1].name  # outputs are (label, probabilities)
+        self.feature_names = json.loads(self.session.get_modelmeta().custom_metadata_map['feature_names'])
+
+    def predict_proba(self, X):
+        # onnxruntime wants row-major input; a no-op for the single row and for score_batch's C-ordered chunks
+        return self.session.run([self.proba_name], {self.input_name: np.ascontiguousarray(X)})[0]